@@ -1,13 +1,13 @@
 #coding: utf-8
 from __future__ import print_function
 
-import csv, json, copy, re, argparse, os, requests
+import csv, json, copy, re, argparse, os, sys, heapq, gzip, shutil, struct, zipfile, zlib, multiprocessing, requests
 
 import numpy, scipy, fastcluster, sklearn, jsmin
 import scipy.cluster.hierarchy as hcluster
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.impute import SimpleImputer
-from scipy import spatial
+from scipy import spatial, sparse
 
 import randomcolor
 
@@ -29,11 +29,157 @@ except Exception as e:
     RDKIT = False
     print("RDKit not found: Cheminformatic-based functionality not available...")
 
+INCHLIB_JS = "inchlib-1.2.0.min.js"
+LIBDIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+try:
+    import pyarrow, pyarrow.parquet, pyarrow.feather
+    PYARROW = True
+except Exception as e:
+    PYARROW = False
+
+try:
+    import resource
+except Exception as e:
+    resource = False
+
 LINKAGES = ["single", "complete", "average", "centroid", "ward", "median", "weighted"]
 RAW_LINKAGES = ["ward", "centroid"]
 DISTANCES = {"numeric": ["braycurtis", "canberra", "chebyshev", "cityblock", "correlation", "cosine", "euclidean", "mahalanobis", "minkowski", "seuclidean", "sqeuclidean"],
               "binary": ["dice","hamming","jaccard","kulsinski","matching","rogerstanimoto","russellrao","sokalmichener","sokalsneath","yule"]}
 
+def _divide(numerator, denominator):
+    return numpy.divide(numerator, denominator, out=numpy.zeros(numpy.broadcast(numerator, denominator).shape), where=denominator != 0)
+
+# binary distances computed from the counts of matching (ntt, nff) and mismatching (ntf, nft) features out of n features
+SPARSE_DISTANCES = {
+    "dice": lambda ntt, ntf, nft, nff, n: _divide(ntf + nft, 2*ntt + ntf + nft),
+    "hamming": lambda ntt, ntf, nft, nff, n: (ntf + nft)/float(n),
+    "jaccard": lambda ntt, ntf, nft, nff, n: _divide(ntf + nft, ntt + ntf + nft),
+    "kulsinski": lambda ntt, ntf, nft, nff, n: (ntf + nft - ntt + n)/(ntf + nft + float(n)),
+    "matching": lambda ntt, ntf, nft, nff, n: (ntf + nft)/float(n),
+    "rogerstanimoto": lambda ntt, ntf, nft, nff, n: _divide(2*(ntf + nft), ntt + nff + 2*(ntf + nft)),
+    "russellrao": lambda ntt, ntf, nft, nff, n: (n - ntt)/float(n),
+    "sokalmichener": lambda ntt, ntf, nft, nff, n: _divide(2*(ntf + nft), ntt + nff + 2*(ntf + nft)),
+    "sokalsneath": lambda ntt, ntf, nft, nff, n: _divide(2*(ntf + nft), ntt + 2*(ntf + nft)),
+    "yule": lambda ntt, ntf, nft, nff, n: _divide(2*ntf*nft, ntt*nff + ntf*nft),
+}
+SPARSE_BLOCK_SIZE = 2**24
+
+# Lance-Williams updates of fastcluster, the distance of the cluster k to the merge of the clusters a and b
+# (merged in the height h) from the distances of k to a and b, ward, centroid and median work with squared euclidean distances
+LANCE_WILLIAMS = {
+    "single": lambda a, b, h, na, nb, nk: min(a, b),
+    "complete": lambda a, b, h, na, nb, nk: max(a, b),
+    "average": lambda a, b, h, na, nb, nk: (na*a + nb*b)/float(na + nb),
+    "weighted": lambda a, b, h, na, nb, nk: (a + b)/2.0,
+    "ward": lambda a, b, h, na, nb, nk: numpy.sqrt(max(0.0, ((na + nk)*a*a + (nb + nk)*b*b - nk*h*h)/float(na + nb + nk))),
+    "centroid": lambda a, b, h, na, nb, nk: numpy.sqrt(max(0.0, (na*a*a + nb*b*b)/float(na + nb) - na*nb*h*h/float((na + nb)**2))),
+    "median": lambda a, b, h, na, nb, nk: numpy.sqrt(max(0.0, (a*a + b*b)/2.0 - h*h/4.0)),
+}
+
+# color scales of InCHlib.js used for the heatmap tiles
+HEATMAP_COLORS = {
+    "YlGn": {"start": (255, 255, 204), "end": (35, 132, 67)},
+    "GnBu": {"start": (240, 249, 232), "end": (43, 140, 190)},
+    "BuGn": {"start": (237, 248, 251), "end": (35, 139, 69)},
+    "PuBu": {"start": (241, 238, 246), "end": (5, 112, 176)},
+    "BuPu": {"start": (237, 248, 251), "end": (136, 65, 157)},
+    "RdPu": {"start": (254, 235, 226), "end": (174, 1, 126)},
+    "PuRd": {"start": (241, 238, 246), "end": (206, 18, 86)},
+    "OrRd": {"start": (254, 240, 217), "end": (215, 48, 31)},
+    "Purples2": {"start": (242, 240, 247), "end": (106, 81, 163)},
+    "Blues": {"start": (239, 243, 255), "end": (33, 113, 181)},
+    "Greens": {"start": (237, 248, 233), "end": (35, 139, 69)},
+    "Oranges": {"start": (254, 237, 222), "end": (217, 71, 1)},
+    "Reds": {"start": (254, 229, 217), "end": (203, 24, 29)},
+    "Greys": {"start": (247, 247, 247), "end": (82, 82, 82)},
+    "PuOr": {"start": (230, 97, 1), "end": (94, 60, 153)},
+    "BrBG": {"start": (166, 97, 26), "end": (1, 133, 113)},
+    "RdBu": {"start": (202, 0, 32), "end": (5, 113, 176)},
+    "RdGy": {"start": (202, 0, 32), "end": (64, 64, 64)},
+    "BuYl": {"start": (5, 113, 176), "end": (250, 233, 42)},
+    "YlOrR": {"start": (255, 255, 178), "middle": (204, 76, 2), "end": (227, 26, 28)},
+    "YlOrB": {"start": (255, 255, 212), "middle": (204, 76, 2), "end": (5, 112, 176)},
+    "PRGn2": {"start": (123, 50, 148), "middle": (202, 0, 32), "end": (0, 136, 55)},
+    "PiYG2": {"start": (208, 28, 139), "middle": (255, 255, 178), "end": (77, 172, 38)},
+    "YlGnBu": {"start": (255, 255, 204), "middle": (35, 132, 67), "end": (34, 94, 168)},
+    "RdYlBu": {"start": (215, 25, 28), "middle": (255, 255, 178), "end": (44, 123, 182)},
+    "RdYlGn": {"start": (215, 25, 28), "middle": (255, 255, 178), "end": (26, 150, 65)},
+    "BuWhRd": {"start": (33, 113, 181), "middle": (255, 255, 255), "end": (215, 25, 28)},
+    "RdLrBu": {"start": (215, 25, 28), "middle": (254, 229, 217), "end": (44, 123, 182)},
+    "RdBkGr": {"start": (215, 25, 28), "middle": (0, 0, 0), "end": (35, 139, 69)},
+    "RdLrGr": {"start": (215, 25, 28), "middle": (254, 229, 217), "end": (35, 139, 69)},
+}
+
+def _get_peak_rss_():
+    if not resource:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss*1024
+
+def _colorize_(values, mins, maxs, middles, color_scale):
+    color = HEATMAP_COLORS[color_scale]
+    start = numpy.array(color["start"], dtype=float)
+    end = numpy.array(color["end"], dtype=float)
+
+    if "middle" in color:
+        upper = values >= middles
+        low = numpy.where(upper, middles, mins)
+        high = numpy.where(upper, maxs, middles)
+        c1 = numpy.where(upper[..., None], numpy.array(color["middle"], dtype=float), start)
+        c2 = numpy.where(upper[..., None], end, numpy.array(color["middle"], dtype=float))
+    else:
+        low, high, c1, c2 = mins + numpy.zeros_like(values), maxs + numpy.zeros_like(values), start, end
+
+    position = numpy.clip(_divide(values - low, high - low), 0, 1)
+    rgba = numpy.zeros(values.shape + (4,), dtype=numpy.uint8)
+    rgba[..., :3] = numpy.round(c1 + position[..., None]*(c2 - c1))
+    rgba[..., :3][numpy.broadcast_to(mins == maxs, values.shape)] = start
+    rgba[..., 3] = numpy.where(numpy.isnan(values), 0, 255)
+    return rgba
+
+def _downsample_(rgba):
+    # the last odd row/column is padded, only the real cells of the 2x2 blocks are averaged
+    rows, columns = rgba.shape[:2]
+    padded = numpy.zeros(((rows + 1)//2*2, (columns + 1)//2*2, 5), dtype=float)
+    padded[:rows, :columns, :4] = rgba
+    padded[:rows, :columns, 4] = 1
+    blocks = padded.reshape(padded.shape[0]//2, 2, padded.shape[1]//2, 2, 5)
+    alpha = blocks[..., 3].sum(axis=(1, 3))
+    cells = blocks[..., 4].sum(axis=(1, 3))
+    downsampled = numpy.zeros(alpha.shape + (4,), dtype=numpy.uint8)
+    downsampled[..., :3] = numpy.round(_divide((blocks[..., :3]*blocks[..., 3:4]).sum(axis=(1, 3)), alpha[..., None]))
+    downsampled[..., 3] = numpy.round(alpha/cells)
+    return downsampled
+
+def _write_png_(filename, rgba):
+    height, width = rgba.shape[:2]
+    scanlines = numpy.zeros((height, width*4 + 1), dtype=numpy.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, width*4)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(filename, "wb") as output:
+        output.write(b"\x89PNG\r\n\x1a\n")
+        output.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        output.write(chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6)))
+        output.write(chunk(b"IEND", b""))
+
+def _render_tile_strip_(task):
+    # writes one row of tiles of a pyramid level and returns the strip downsampled for the next level
+    leveldir, strip_index, strip, descs, color_scale, tile_size = task
+    if sparse.issparse(strip):
+        strip = strip.toarray()
+    if descs:
+        strip = _colorize_(strip, descs["min"], descs["max"], descs["middle"], color_scale)
+
+    for column_index, start in enumerate(range(0, strip.shape[1], tile_size)):
+        _write_png_(os.path.join(leveldir, "{}_{}.png".format(strip_index, column_index)), strip[:, start:start + tile_size])
+
+    return _downsample_(strip)
+
 class Dendrogram():
     """Class which handles the generation of cluster heatmap format of clustered data. 
     As an input it takes a Cluster instance with clustered data."""
@@ -43,7 +189,6 @@ class Dendrogram():
         self.datatype = clustering.datatype
         self.axis = clustering.clustering_axis
         self.clustering = clustering.clustering
-        self.tree = hcluster.to_tree(self.clustering)
         self.data = clustering.data
         self.data_names = clustering.data_names
         self.labels = clustering.labels
@@ -75,7 +220,12 @@ class Dendrogram():
         for n, node in node_id2node.items():
 
             if node["count"] == 1:
-                data = self.data[n]
+                if sparse.issparse(self.data):
+                    data = self.data[n].toarray()[0].tolist()
+                elif isinstance(self.data, numpy.ndarray):
+                    data = self.data[n].tolist()
+                else:
+                    data = self.data[n]
                 node["objects"] = [self.data_names[n]]
                 if self.labels:
                     node["label"] = self.labels[n]
@@ -266,12 +416,12 @@ class Dendrogram():
 
     def __get_distance_threshold__(self, cluster_count):
         print("Calculating distance threshold...")
-        if cluster_count >= self.tree.count:
+        if cluster_count >= len(self.clustering) + 1:
             return -1
         
         i = 0
         count = cluster_count + 1
-        test_step = self.tree.dist/2
+        test_step = self.clustering[-1][2]/2
 
         while test_step >= 0.1:
             count = len(set([c for c in hcluster.fcluster(self.clustering, i, "distance")]))
@@ -306,19 +456,71 @@ class Dendrogram():
     def __minify_data(self, data):
         return jsmin.jsmin(str(data))
 
-    def export_cluster_heatmap_as_html(self, htmldir="."):
-        """Export simple HTML page with embedded cluster heatmap and dependencies to given directory."""
+    def export_cluster_heatmap_as_html(self, htmldir=".", libdir=LIBDIR, compress_data=False, download_libs=True):
+        """Export simple HTML page with cluster heatmap and dependencies to given directory.
+        The InCHlib, jQuery and KineticJS sources are copied from libdir (by default the directory with the bundled inchlib-1.2.0.min.js),
+        the missing ones are downloaded from the InCHlib server (or raise an exception when download_libs is False).
+        All sources are collected before anything is written, so a failed export doesn't leave a partial page behind.
+        The cluster heatmap is written to a separate compact inchlib_data.js file included by the page, so it can be opened directly from disk.
+        With compress_data the data are stored gzip-compressed as inchlib_data.json.gz and fetched by the page instead,
+        which requires serving the directory over HTTP by a server which doesn't send the file with Content-Encoding: gzip
+        (the browser would decompress the data twice then)."""
+        lib2url = {
+            INCHLIB_JS: "https://openscreen.cz/software/inchlib/static/js/{}".format(INCHLIB_JS),
+            "jquery-2.0.3.min.js": "https://openscreen.cz/software/inchlib/static/js/jquery-2.0.3.min.js",
+            "kinetic-v5.1.0.min.js": "https://openscreen.cz/software/inchlib/static/js/kinetic-v5.1.0.min.js"
+        }
+        lib2source = {}
+
+        for lib, url in lib2url.items():
+            local_lib = os.path.join(libdir, lib)
+
+            if os.path.exists(local_lib):
+                lib2source[lib] = local_lib
+                continue
+
+            if not download_libs:
+                raise Exception("\nCan't find file {} in {}.\nPlease place the file to {} or allow downloading it from {}.\n".format(lib, libdir, libdir, url))
+
+            print("File {} not found in {}, downloading it from {}...".format(lib, libdir, url))
+            try:
+                source = requests.get(url)
+                source.raise_for_status()
+                lib2source[lib] = source.content
+            
+            except Exception as e:
+                raise Exception("\nCan't download file {}.\nPlease place the file to {} or check your internet connection and try again.\n".format(url, libdir))
+
         if not os.path.exists(htmldir):
             os.makedirs(htmldir)
-        dendrogram_json = json.dumps(self.dendrogram, indent=4)
+
+        dendrogram_json = json.dumps(self.dendrogram, separators=(",", ":"))
+
+        if compress_data:
+            data_file = "inchlib_data.json.gz"
+            with gzip.open(os.path.join(htmldir, data_file), "wb") as output:
+                output.write(dendrogram_json.encode("utf-8"))
+
+            data_script = ""
+            load_data = """fetch("{}").then(function(response) {{
+                    return new Response(response.body.pipeThrough(new DecompressionStream("gzip"))).json();
+                }}).then(draw_inchlib);""".format(data_file)
+        else:
+            data_file = "inchlib_data.js"
+            with open(os.path.join(htmldir, data_file), "w") as output:
+                output.write("var inchlib_data = {};\n".format(dendrogram_json))
+
+            data_script = """<script src="{}"></script>
+            """.format(data_file)
+            load_data = "draw_inchlib(inchlib_data);"
+
         template = """<html>
         <head>
             <script src="jquery-2.0.3.min.js"></script>
             <script src="kinetic-v5.1.0.min.js"></script>
-            <script src="inchlib-1.1.0.js"></script>
-            <script>
-            $(document).ready(function() {{
-                var data = {};
+            <script src="{inchlib}"></script>
+            {data_script}<script>
+            function draw_inchlib(data) {{
                 var inchlib = new InCHlib({{
                     target: "inchlib",
                     max_height: 1200,
@@ -326,6 +528,10 @@ class Dendrogram():
                 }});
                 inchlib.read_data(data);
                 inchlib.draw();
+            }}
+
+            $(document).ready(function() {{
+                {load_data}
             }});
             </script>
         </head>
@@ -333,28 +539,132 @@ class Dendrogram():
         <body>
             <div id="inchlib"></div>
         </body>
-        </html>""".format(dendrogram_json)
+        </html>""".format(inchlib=INCHLIB_JS, data_script=data_script, load_data=load_data)
 
-        lib2url = {
-            "inchlib-1.1.0.js": "https://openscreen.cz/software/inchlib/static/js/inchlib-1.1.0.js",
-            "jquery-2.0.3.min.js": "https://openscreen.cz/software/inchlib/static/js/jquery-2.0.3.min.js",
-            "kinetic-v5.1.0.min.js": "https://openscreen.cz/software/inchlib/static/js/kinetic-v5.1.0.min.js"
-        }
-        
-        for lib, url in lib2url.items():
-            try:
-                source = requests.get(url)
-                source_html = source.content
+        for lib, source in lib2source.items():
+            output_lib = os.path.join(htmldir, lib)
 
-                with open(os.path.join(htmldir, lib), "w") as output:
-                    output.write(source_html)
-            
-            except Exception as e:
-                raise Exception("\nCan't download file {}.\nPlease check your internet connection and try again.\nIf the error persists there can be something wrong with the InCHlib server.\n".format(url))
+            if isinstance(source, bytes):
+                with open(output_lib, "wb") as output:
+                    output.write(source)
+            elif not os.path.exists(output_lib) or not os.path.samefile(source, output_lib):
+                shutil.copyfile(source, output_lib)
 
         with open(os.path.join(htmldir, "inchlib.html"), "w") as output:
             output.write(template)
 
+    def export_heatmap_tiles(self, tiledir, tile_size=256, heatmap_colors="Greens", metadata_colors="Reds", workers=None):
+        """Renders the clustered data (and metadata when added) ordered by the dendrogram to a pyramid of PNG tiles
+        colored like in InCHlib.js (the default color scales are the ones set in its default settings). The tile_size must be even.
+        Level 0 has one pixel per heatmap cell, every next level is downsampled by 2.
+        Tiles are stored as tiledir/<data|metadata>/<level>/<row>_<column>.png and described in tiledir/tiles.json,
+        so the dendrogram itself can be exported without the data (write_data=False). Tiles are rendered by the given
+        count of worker processes (all CPUs by default)."""
+        if not self.dendrogram:
+            raise Exception("You must create dendrogram before exporting heatmap tiles.")
+        if self.compress:
+            raise Exception("Heatmap tiles can't be exported from the compressed dendrogram.")
+        if tile_size < 2 or tile_size % 2:
+            raise Exception("The tile size must be even, the tiles are downsampled by 2 for the next level.")
+
+        row_order = hcluster.leaves_list(self.clustering)
+        tiles = {"tile_size": tile_size, "row_order": [self.data_names[i] for i in row_order]}
+
+        if sparse.issparse(self.data):
+            values = self.data.tocsr()
+        elif isinstance(self.data, numpy.ndarray):
+            # strips are indexed directly from the (possibly memory mapped) matrix
+            values = self.data
+        else:
+            values = numpy.array([[numpy.nan if v is None else v for v in row] for row in self.data], dtype=float)
+
+        tiles["data"] = self.__render_tile_pyramid__(os.path.join(tiledir, "data"), values, row_order, self.__get_column_descs__(values), heatmap_colors, tile_size, workers)
+        tiles["data"]["feature_names"] = list(self.header) if self.header else []
+
+        if "metadata" in self.dendrogram:
+            metadata, str2num = self.__get_metadata_matrix__()
+
+            if not metadata.shape[1]:
+                print("Metadata are empty, skipping metadata tiles...")
+            else:
+                descs = self.__get_column_descs__(metadata)
+                for i, hash_object in str2num.items():
+                    descs["min"][i], descs["max"][i], descs["middle"][i] = 0, len(hash_object) - 1, (len(hash_object) - 1)/2.0
+
+                tiles["metadata"] = self.__render_tile_pyramid__(os.path.join(tiledir, "metadata"), metadata, row_order, descs, metadata_colors, tile_size, workers)
+                tiles["metadata"]["feature_names"] = list(self.dendrogram["metadata"].get("feature_names", []))
+                tiles["metadata"]["str2num"] = {i: hash_object for i, hash_object in str2num.items()}
+
+        with open(os.path.join(tiledir, "tiles.json"), "w") as output:
+            json.dump(tiles, output)
+        return tiles
+
+    def __get_column_descs__(self, values, chunk_size=256):
+        descs = {"min": [], "max": [], "middle": []}
+        for start in range(0, values.shape[1], chunk_size):
+            columns = values[:, start:start + chunk_size]
+            columns = numpy.sort(columns.toarray() if sparse.issparse(columns) else columns, axis=0)
+            counts = (~numpy.isnan(columns)).sum(axis=0)
+            for i, count in enumerate(counts):
+                column = columns[:count, i]
+                descs["min"].append(column[0] if count else numpy.nan)
+                descs["max"].append(column[-1] if count else numpy.nan)
+                descs["middle"].append(column[int(round((count - 1)/2.0))] if count else numpy.nan)
+
+        return {key: numpy.array(value, dtype=float) for key, value in descs.items()}
+
+    def __get_metadata_matrix__(self):
+        nodes = self.dendrogram["metadata"]["nodes"] or {}
+        column_count = max([len(row) for row in nodes.values()] or [0])
+        metadata = numpy.full((len(self.data_names), column_count), numpy.nan)
+        str2num = {}
+
+        for j in range(column_count):
+            column = {n: row[j] for n, row in nodes.items() if j < len(row) and not row[j] in [None, ""]}
+            try:
+                for n, value in column.items():
+                    metadata[n, j] = float(value)
+            except ValueError:
+                hash_object = {}
+                for n in sorted(column):
+                    metadata[n, j] = hash_object.setdefault(str(column[n]), len(hash_object))
+                str2num[j] = hash_object
+
+        return metadata, str2num
+
+    def __render_tile_pyramid__(self, tiledir, values, row_order, descs, color_scale, tile_size, workers):
+        workers = workers or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        mapper = pool.imap if pool else map
+        levels = []
+        level = None
+        rows, columns = len(row_order), values.shape[1]
+
+        try:
+            while True:
+                leveldir = os.path.join(tiledir, str(len(levels)))
+                if not os.path.exists(leveldir):
+                    os.makedirs(leveldir)
+
+                if level is None:
+                    tasks = ((leveldir, i, values[row_order[start:start + tile_size]], descs, color_scale, tile_size) for i, start in enumerate(range(0, rows, tile_size)))
+                else:
+                    tasks = ((leveldir, i, level[start:start + tile_size], None, color_scale, tile_size) for i, start in enumerate(range(0, rows, tile_size)))
+
+                print("Rendering heatmap tiles:", leveldir)
+                level = numpy.concatenate(list(mapper(_render_tile_strip_, tasks)))
+                levels.append({"rows": rows, "columns": columns, "tile_rows": -(-rows//tile_size), "tile_columns": -(-columns//tile_size)})
+
+                if max(rows, columns) <= tile_size:
+                    break
+                rows, columns = level.shape[:2]
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        return {"levels": levels}
+
     def add_metadata_from_file(self, metadata_file, delimiter, header=True, metadata_compressed_value="median"):
         """Adds metadata from csv file.
         Metadata_compressed_value specifies the resulted value when the data are compressed (median/mean/frequency)"""
@@ -431,7 +741,7 @@ class Dendrogram():
         self.add_column_metadata(column_metadata, header)
 
     def __check_column_metadata_length__(self):
-        features_length = len(self.data[0])
+        features_length = len(self.data[0]) if not sparse.issparse(self.data) else self.data.shape[1]
         for row in self.column_metadata:
             if features_length != len(row):
                 raise Exception("Column metadata length and features length must be the same.")
@@ -545,10 +855,16 @@ class Dendrogram():
         return value
 
 class Cluster():
-    """Class for data clustering"""
+    """Class for data clustering. In the lean mode the intermediate data (distance vector, molecules, fingerprints,
+    original data when not written to the heatmap) are released as soon as the next stage doesn't need them,
+    rows can't be inserted into the lean clustering then. Only the peak memory (RSS) of the whole process is reported
+    after the clustering, the savings are the difference to the same run without the lean mode."""
 
-    def __init__(self):
+    def __init__(self, lean=False):
         self.write_original = False
+        self.normalization = False
+        self.lean = lean
+        self.row_buffers = {}
 
     def read_csv(self, filename, delimiter=",", header=False, missing_values=False, datatype="numeric", compound_structure_field=False, add_structures=False, label_field=False):
         """Reads data from the CSV file"""
@@ -557,6 +873,144 @@ class Cluster():
         rows = [row for row in csv_reader]
         self.read_data(rows, header, missing_values, datatype, compound_structure_field, add_structures, label_field)
 
+    def read_sparse_csv(self, filename, delimiter=",", header=False):
+        """Reads binary data from the CSV file in a sparse triplet format (row id, column name[, value]).
+        Rows and columns are ordered by their first occurrence, missing triplets are zeros."""
+        csv_reader = csv.reader(open(filename, "r"), delimiter=delimiter)
+        if header:
+            next(csv_reader)
+
+        row2index = {}
+        column2index = {}
+        rows, columns, values = [], [], []
+
+        for triplet in csv_reader:
+            rows.append(row2index.setdefault(triplet[0], len(row2index)))
+            columns.append(column2index.setdefault(triplet[1], len(column2index)))
+            values.append(float(triplet[2]) if len(triplet) > 2 else 1)
+
+        matrix = sparse.coo_matrix((values, (rows, columns)), shape=(len(row2index), len(column2index)))
+        self.filename = filename
+        self.read_sparse(matrix, sorted(row2index, key=row2index.get), header=sorted(column2index, key=column2index.get))
+
+    def read_sparse(self, matrix, data_names, header=False, labels=False, smiles=False, add_structures=False):
+        """Reads binary data in a form of scipy.sparse matrix, data_names are the row ids.
+        Header, labels and smiles can be given as lists. The data stay sparse
+        and the binary distances are calculated from the nonzero features only."""
+        self.__read_matrix__((sparse.csr_matrix(matrix) != 0).astype(float), data_names, header, labels, smiles, "binary", add_structures)
+
+    def read_npy(self, filename, data_names=None, header=None, labels=None, smiles=None, datatype="numeric", add_structures=False):
+        """Reads numeric matrix from the .npy or .npz file without copying it to memory (memory mapped).
+        The .npz file contains the matrix under the "data" key (stored uncompressed to be memory mapped)
+        and optionally the "data_names", "header", "labels" and "smiles" arrays. For the .npy file
+        these arrays are read from the sidecar files named e.g. data_data_names.npy for data.npy.
+        Arrays given as parameters take precedence. The matrix is used as it is (also float32 is not converted),
+        it must not contain missing (NaN) values, use read_csv with missing_values for such data."""
+        fields = {"data_names": data_names, "header": header, "labels": labels, "smiles": smiles}
+
+        if filename.endswith(".npz"):
+            with numpy.load(filename, allow_pickle=False) as npz:
+                for field in fields:
+                    if fields[field] is None and field in npz.files:
+                        fields[field] = npz[field]
+            matrix = self.__memmap_npz_member__(filename, "data")
+        else:
+            matrix = numpy.load(filename, mmap_mode="r", allow_pickle=False)
+            stem = os.path.splitext(filename)[0]
+            for field in fields:
+                sidecar = "{}_{}.npy".format(stem, field)
+                if fields[field] is None and os.path.exists(sidecar):
+                    fields[field] = numpy.load(sidecar, allow_pickle=False)
+
+        if fields["data_names"] is None:
+            fields["data_names"] = range(matrix.shape[0])
+
+        self.filename = filename
+        self.__read_matrix__(matrix, fields["data_names"], fields["header"], fields["labels"], fields["smiles"], datatype, add_structures)
+
+    def __memmap_npz_member__(self, filename, name):
+        with zipfile.ZipFile(filename) as npz:
+            info = npz.getinfo("{}.npy".format(name))
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                print("Matrix in {} is compressed, reading it to memory...".format(filename))
+                with npz.open(info) as member:
+                    return numpy.lib.format.read_array(member, allow_pickle=False)
+
+        with open(filename, "rb") as npz_file:
+            npz_file.seek(info.header_offset)
+            name_length, extra_length = struct.unpack("<HH", npz_file.read(30)[26:30])
+            npz_file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = numpy.lib.format.read_magic(npz_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(npz_file)
+            else:
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(npz_file)
+            offset = npz_file.tell()
+
+        return numpy.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
+
+    def read_columnar(self, filename, id_field=None, label_field=False, compound_structure_field=False, add_structures=False, datatype="numeric"):
+        """Reads data from the columnar Parquet or Arrow/Feather file (requires pyarrow). The file is memory mapped,
+        but the feature columns are copied to a single float matrix (so the data are held in memory once).
+        Row ids are read from the id_field (first column by default), all remaining columns are the data features.
+        The features must not contain missing (null) values, use read_csv with missing_values for such data."""
+        if not PYARROW:
+            raise Exception("pyarrow is needed to read columnar files.")
+
+        if filename.endswith(".parquet"):
+            table = pyarrow.parquet.read_table(filename, memory_map=True)
+        else:
+            table = pyarrow.feather.read_table(filename, memory_map=True)
+
+        id_field = id_field or table.column_names[0]
+        special_fields = [f for f in [id_field, label_field, compound_structure_field] if f]
+        header = [f for f in table.column_names if not f in special_fields]
+
+        null_fields = [f for f in header if table.column(f).null_count]
+        if null_fields:
+            raise Exception("Columns {} in {} contain missing values, please impute them or use the CSV input with missing values.".format(", ".join(null_fields), filename))
+
+        matrix = numpy.empty((table.num_rows, len(header)), dtype=float)
+        for i, field in enumerate(header):
+            matrix[:, i] = table.column(field).to_numpy()
+
+        labels = table.column(label_field).to_pylist() if label_field else None
+        smiles = table.column(compound_structure_field).to_pylist() if compound_structure_field else None
+
+        self.filename = filename
+        self.__read_matrix__(matrix, table.column(id_field).to_pylist(), header, labels, smiles, datatype, add_structures)
+
+    def __read_matrix__(self, matrix, data_names, header, labels, smiles, datatype, add_structures):
+        if matrix.shape[0] != len(data_names):
+            raise Exception("The count of data names must be the same as the count of matrix rows.")
+
+        self.datatype = datatype
+        self.missing_values = False
+        self.header = [str(h) for h in header] if not header is None and not header is False and len(header) else False
+        self.compound_structure_field = "smiles" if not smiles is None and not smiles is False else False
+        self.label_field = False
+        self.labels = [str(l) for l in labels] if not labels is None and not labels is False else False
+        self.smiles = [str(s) for s in smiles] if self.compound_structure_field else False
+        self.rdmols = False
+        self.fpobjs = False
+        self.add_structures = add_structures
+
+        if not sparse.issparse(matrix):
+            self.__check_missing_values__(matrix)
+
+        self.data_names = [str(name) for name in data_names]
+        self.data = matrix
+        self.original_data = self.data
+
+    def __check_missing_values__(self, matrix):
+        # checked by blocks of rows, so the memory mapped matrix isn't loaded at once
+        block_size = max(1, SPARSE_BLOCK_SIZE//max(matrix.shape[1], 1))
+        for start in range(0, matrix.shape[0], block_size):
+            rows = numpy.isnan(matrix[start:start + block_size]).any(axis=1).nonzero()[0]
+            if len(rows):
+                raise Exception("The matrix contains missing (NaN) values in row {}, please impute them or use the CSV input with missing values.".format(start + rows[0]))
+
     def read_data(self, rows, header=False, missing_values=False, datatype="numeric", compound_structure_field=False, add_structures=False, label_field=False):
         """Reads data in a form of list of lists (tuples)"""
         self.datatype = datatype
@@ -593,14 +1047,15 @@ class Cluster():
         
         self.data_names = [str(row[0]) for row in rows[data_start:]]
         self.data = numpy.array([row[1:] for row in rows[data_start:]])
-        self.original_data = copy.deepcopy(self.data)
+        self.original_data = copy.deepcopy(self.data) if not self.lean else self.data
 
         if not self.missing_values is False:
             self.data, self.missing_values_indexes = self.__impute_missing_values__(self.data)
             self.original_data = self.__return_missing_values__(copy.deepcopy(self.data), self.missing_values_indexes)
 
+        shared_original = self.original_data is self.data
         self.original_data = [[float(val) if not val is None else None for val in r] for r in self.original_data]
-        self.data = [[float(val) if not val is None else None for val in r] for r in self.data]
+        self.data = [[float(val) if not val is None else None for val in r] for r in self.data] if not shared_original else self.original_data
         
     def __impute_missing_values__(self, data):
         
@@ -629,18 +1084,32 @@ class Cluster():
         
     def normalize_data(self, feature_range=(0,1), write_original=False):
         """Normalizes data to a scale from 0 to 1. When write_original is set to True, 
-        the normalized data will be clustered, but original data will be written to the heatmap."""
+        the normalized data will be clustered, but original data will be written to the heatmap.
+        Sparse binary data are already in this scale and are left as they are."""
         self.write_original = write_original
+        if sparse.issparse(self.data):
+            print("Sparse binary data are not normalized...")
+            return
+
         min_max_scaler = MinMaxScaler(feature_range)
         self.data = min_max_scaler.fit_transform(self.data)
-        self.data = [[round(v, 3) for v in row] for row in self.data]
+        self.normalization = {"min": min_max_scaler.min_.tolist(), "scale": min_max_scaler.scale_.tolist()}
+        if isinstance(self.original_data, numpy.ndarray):
+            self.data = numpy.round(self.data, 3)
+        else:
+            self.data = [[round(v, 3) for v in row] for row in self.data]
+
+        if self.lean and not self.write_original and not self.compound_structure_field and self.datatype != "nominal":
+            self.original_data = self.data
 
-    def cluster_data(self, row_distance="euclidean", row_linkage="single", axis="row", column_distance="euclidean", column_linkage="ward", cluster_by_structures=False):
+    def cluster_data(self, row_distance="euclidean", row_linkage="single", axis="row", column_distance="euclidean", column_linkage="ward", cluster_by_structures=False, collapse_duplicates=False):
         """Performs clustering according to the given parameters.
         @datatype - numeric/binary
         @row_distance/column_distance - see. DISTANCES variable
         @row_linkage/column_linkage - see. LINKAGES variable
         @axis - row/both
+        @collapse_duplicates - cluster only unique rows (fingerprints), duplicates are joined to them in zero distance (single and complete linkage only).
+        The resulting dendrogram is the same for single and complete linkage, other linkages ignore the duplicates' weights.
         """
         self.clustered_by_structures = False
 
@@ -648,6 +1117,8 @@ class Cluster():
             print("Generating structure fingerprints...")
             self.rdmols = [Chem.MolFromSmiles(smiles) for smiles in self.smiles]
             self.fpobjs = [FP2FNC["ecfp4"](rdmol).ToList() for rdmol in self.rdmols]
+            if self.lean:
+                self.rdmols = False
             self.datatype = "binary"
             self.data = self.fpobjs
             
@@ -663,33 +1134,147 @@ class Cluster():
 
         print("Clustering rows:", row_distance, row_linkage)
         self.clustering_axis = axis
-        row_linkage = str(row_linkage)
-        
-        if row_linkage in RAW_LINKAGES:
-            self.clustering = fastcluster.linkage(self.data, method=row_linkage, metric=row_distance)
-
-        else:
-            self.distance_vector = fastcluster.pdist(self.data, row_distance)
-
-            if self.datatype == "numeric" and not row_distance in DISTANCES[self.datatype]:
-                raise Exception("".join(["When clustering numeric data you must choose from these distance measures: ", ", ".join(DISTANCES[self.datatype])]))
-            elif (self.datatype == "binary" or self.datatype == "nominal") and not row_distance in DISTANCES[self.datatype]:
-                raise Exception("".join(["When clustering binary or nominal data you must choose from these distance measures: ", ", ".join(DISTANCES[self.datatype])]))
-
-            self.clustering = fastcluster.linkage(self.distance_vector, method=str(row_linkage))
+        self.row_distance = row_distance
+        self.row_linkage = str(row_linkage)
+        self.collapse_duplicates = collapse_duplicates
+        # the matrix (e.g. float32 memmap) is passed to the linkage as it is, it makes its own float64 copy if needed
+        self.clustering_data = self.data if sparse.issparse(self.data) or isinstance(self.data, numpy.ndarray) else numpy.asarray(self.data, dtype=float)
+        if self.lean and self.clustered_by_structures:
+            self.data = self.original_data
+            self.fpobjs = False
 
+        self.__cluster_rows__()
+        if self.lean:
+            self.distance_vector = False
+            self.clustering_data = False
 
         if not self.missing_values is False:
             self.data = self.__return_missing_values__(self.data, self.missing_values_indexes)
         
         self.column_clustering = []
 
-        if axis == "both" and len(self.data[0]) > 2:
+        if axis == "both" and (self.data.shape[1] if sparse.issparse(self.data) else len(self.data[0])) > 2:
             print("Clustering columns:", column_distance, column_linkage)
             self.__cluster_columns__(column_distance, column_linkage)
         
         if self.write_original or self.datatype == "nominal" or self.clustered_by_structures:
             self.data = self.original_data
+        elif self.lean:
+            self.original_data = self.data
+
+        if self.lean:
+            peak_rss = _get_peak_rss_()
+            print("Lean mode peak memory (RSS): {}".format("{:.1f} MB".format(peak_rss/1024.0**2) if peak_rss else "unknown"))
+
+    def __cluster_rows__(self):
+        clustering_data = self.clustering_data
+        duplicates = False
+
+        if self.collapse_duplicates and not self.row_linkage in ["single", "complete"]:
+            # cluster sizes (weights) of the other linkages would change, fastcluster can't weight the rows
+            print("Duplicate rows can be collapsed only with single or complete linkage, clustering all rows...")
+            self.collapse_duplicates = False
+
+        if self.collapse_duplicates:
+            duplicates = self.__get_duplicate_groups__(self.clustering_data)
+            if len(duplicates) > 1 and len(duplicates) < self.clustering_data.shape[0]:
+                print("Collapsing duplicate rows: {} unique of {} rows".format(len(duplicates), self.clustering_data.shape[0]))
+                clustering_data = self.clustering_data[[group[0] for group in duplicates]]
+            else:
+                duplicates = False
+
+        if sparse.issparse(clustering_data):
+            if not self.row_distance in DISTANCES["binary"]:
+                raise Exception("".join(["When clustering sparse data you must choose from these distance measures: ", ", ".join(DISTANCES["binary"])]))
+
+            self.distance_vector = self.__sparse_pdist__(clustering_data, self.row_distance)
+            self.clustering = fastcluster.linkage(self.distance_vector, method=self.row_linkage, preserve_input=not self.lean)
+
+        elif self.row_linkage in RAW_LINKAGES:
+            self.clustering = fastcluster.linkage(clustering_data, method=self.row_linkage, metric=self.row_distance)
+
+        else:
+            self.distance_vector = fastcluster.pdist(clustering_data, self.row_distance)
+
+            if self.datatype == "numeric" and not self.row_distance in DISTANCES[self.datatype]:
+                raise Exception("".join(["When clustering numeric data you must choose from these distance measures: ", ", ".join(DISTANCES[self.datatype])]))
+            elif (self.datatype == "binary" or self.datatype == "nominal") and not self.row_distance in DISTANCES[self.datatype]:
+                raise Exception("".join(["When clustering binary or nominal data you must choose from these distance measures: ", ", ".join(DISTANCES[self.datatype])]))
+
+            self.clustering = fastcluster.linkage(self.distance_vector, method=self.row_linkage, preserve_input=not self.lean)
+
+        if duplicates:
+            self.clustering = self.__expand_duplicates__(self.clustering, duplicates)
+
+        self.clustered_count = self.clustering_data.shape[0]
+        self.inserted_count = 0
+        self.drift = 0.0
+
+    def __get_duplicate_groups__(self, matrix):
+        # groups of identical rows in order of their first occurrence, the first row of each group represents it
+        row2group = {}
+        if sparse.issparse(matrix):
+            matrix = matrix.tocsr()
+            matrix.sort_indices()
+            for i in range(matrix.shape[0]):
+                start, end = matrix.indptr[i], matrix.indptr[i+1]
+                row2group.setdefault((matrix.indices[start:end].tobytes(), matrix.data[start:end].tobytes()), []).append(i)
+        else:
+            for i, row in enumerate(matrix):
+                row2group.setdefault(row.tobytes(), []).append(i)
+
+        return list(row2group.values())
+
+    def __expand_duplicates__(self, clustering, duplicates):
+        leaf_count = sum([len(group) for group in duplicates])
+        expanded = []
+        group_ids = []
+        counts = {}
+
+        for group in duplicates:
+            cluster_id = group[0]
+            for i, duplicate in enumerate(group[1:]):
+                expanded.append([cluster_id, duplicate, 0, i + 2])
+                cluster_id = leaf_count + len(expanded) - 1
+                counts[cluster_id] = i + 2
+            group_ids.append(cluster_id)
+
+        offset = leaf_count + len(expanded)
+        for left, right, distance, count in clustering:
+            left, right = [group_ids[int(c)] if c < len(duplicates) else offset + int(c) - len(duplicates) for c in [left, right]]
+            cluster_id = leaf_count + len(expanded)
+            counts[cluster_id] = counts.get(left, 1) + counts.get(right, 1)
+            expanded.append([left, right, distance, counts[cluster_id]])
+
+        return numpy.array(expanded, dtype=float)
+
+    def __sparse_pdist__(self, matrix, distance):
+        # condensed distance vector computed by blocks of rows to keep the dense intermediates small,
+        # upper triangle of each block is written to its (contiguous) place in the preallocated vector
+        row_count = matrix.shape[0]
+        block_size = max(1, SPARSE_BLOCK_SIZE//max(row_count, 1))
+        distance_vector = numpy.empty(row_count*(row_count-1)//2)
+        offset = 0
+
+        for start in range(0, row_count, block_size):
+            end = min(start + block_size, row_count)
+            distances = self.__sparse_distances__(matrix[start:end], matrix[start:], distance)
+            upper = distances[numpy.triu_indices(end - start, 1, row_count - start)]
+            distance_vector[offset:offset + len(upper)] = upper
+            offset += len(upper)
+
+        return distance_vector
+
+    def __sparse_distances__(self, rows, other_rows, distance):
+        rows = sparse.csr_matrix(rows) != 0
+        other_rows = sparse.csr_matrix(other_rows) != 0
+        ntt = numpy.asarray(rows.astype(float).dot(other_rows.T.astype(float)).todense())
+        row_counts = numpy.asarray(rows.sum(axis=1), dtype=float).reshape(-1, 1)
+        other_counts = numpy.asarray(other_rows.sum(axis=1), dtype=float).reshape(1, -1)
+        ntf = row_counts - ntt
+        nft = other_counts - ntt
+        nff = rows.shape[1] - row_counts - other_counts + ntt
+        return SPARSE_DISTANCES[distance](ntt, ntf, nft, nff, rows.shape[1])
 
     def __return_missing_values__(self, data, missing_values_indexes):
         for i, indexes in enumerate(missing_values_indexes):
@@ -699,6 +1284,29 @@ class Cluster():
         return data
 
     def __cluster_columns__(self, column_distance, column_linkage):
+        if sparse.issparse(self.data):
+            if not column_distance in DISTANCES["binary"]:
+                print("Column distance set to jaccard...")
+                column_distance = "jaccard"
+
+            self.column_clustering = fastcluster.linkage(self.__sparse_pdist__(self.data.T.tocsr(), column_distance), method=column_linkage)
+            self.data_order = hcluster.leaves_list(self.column_clustering)
+            self.data = self.data[:, self.data_order[::-1]]
+            self.original_data = self.data
+            if self.header:
+                self.header = self.__reorder_data__([self.header], self.data_order)[0]
+            return
+
+        if isinstance(self.data, numpy.ndarray) and self.missing_values is False:
+            self.column_clustering = fastcluster.linkage(self.data.T, method=column_linkage, metric=column_distance)
+            self.data_order = hcluster.leaves_list(self.column_clustering)
+            shared_original = self.original_data is self.data
+            self.data = self.__reorder_data__(self.data, self.data_order)
+            self.original_data = self.data if shared_original else self.__reorder_data__(self.original_data, self.data_order)
+            if self.header:
+                self.header = self.__reorder_data__([self.header], self.data_order)[0]
+            return
+
         self.data = [list(col) for col in zip(*self.data)]
         if not self.missing_values is False:
             self.data, missing_values_indexes = self.__impute_missing_values__(self.data)
@@ -716,6 +1324,9 @@ class Cluster():
             self.header = self.__reorder_data__([self.header], self.data_order)[0]
 
     def __reorder_data__(self, data, order):
+        if isinstance(data, numpy.ndarray):
+            return data[:, order[::-1]]
+
         for i in range(len(data)):
             reordered_data = []
             for j in order:
@@ -725,18 +1336,371 @@ class Cluster():
 
         return data
 
+    def export_state(self, filename):
+        """Exports the state of the clustered data needed for later insertion of new rows (see insert_rows) to the .npz file.
+        The matrices and the linkage are stored as arrays, only the small settings are stored as JSON."""
+        if self.clustering_data is False:
+            raise Exception("The state of the data clustered in the lean mode can't be exported.")
+
+        state = {
+            "datatype": self.datatype,
+            "missing_values": self.missing_values,
+            "header": self.header,
+            "compound_structure_field": self.compound_structure_field,
+            "label_field": self.label_field,
+            "add_structures": self.add_structures,
+            "write_original": self.write_original,
+            "normalization": self.normalization,
+            "clustering_axis": self.clustering_axis,
+            "clustered_by_structures": self.clustered_by_structures,
+            "row_distance": self.row_distance,
+            "row_linkage": self.row_linkage,
+            "collapse_duplicates": self.collapse_duplicates,
+            "clustered_count": self.clustered_count,
+            "inserted_count": self.inserted_count,
+            "drift": self.drift,
+            "labels": not self.labels is False,
+            "smiles": not self.smiles is False,
+            "matrices": {}
+        }
+
+        arrays = {
+            "data_names": numpy.array(self.data_names, dtype=str),
+            "clustering": numpy.asarray(self.clustering, dtype=float),
+            "column_clustering": numpy.asarray(self.column_clustering, dtype=float),
+            "data_order": numpy.asarray(self.data_order if len(self.column_clustering) else [], dtype=int)
+        }
+        if self.labels:
+            arrays["labels"] = numpy.array(self.labels, dtype=str)
+        if self.smiles:
+            arrays["smiles"] = numpy.array(self.smiles, dtype=str)
+
+        self.__export_matrix__(state, arrays, "data", self.data)
+        if not self.original_data is self.data:
+            self.__export_matrix__(state, arrays, "original_data", self.original_data)
+        if not self.clustering_data is self.data:
+            self.__export_matrix__(state, arrays, "clustering_data", self.clustering_data)
+
+        arrays["state"] = numpy.array(json.dumps(state))
+        with open(filename, "wb") as output:
+            numpy.savez(output, **arrays)
+
+    def read_state(self, filename):
+        """Reads the state of the clustered data exported by export_state from the .npz file"""
+        with numpy.load(filename, allow_pickle=False) as arrays:
+            state = json.loads(str(arrays["state"]))
+            for key in ["datatype", "missing_values", "header", "compound_structure_field", "label_field", "add_structures",
+                        "write_original", "normalization", "clustering_axis", "clustered_by_structures",
+                        "row_distance", "row_linkage", "collapse_duplicates", "clustered_count", "inserted_count", "drift"]:
+                setattr(self, key, state[key])
+
+            self.data_names = arrays["data_names"].tolist()
+            self.labels = arrays["labels"].tolist() if state["labels"] else False
+            self.smiles = arrays["smiles"].tolist() if state["smiles"] else False
+            self.data = self.__import_matrix__(state, arrays, "data")
+            self.original_data = self.__import_matrix__(state, arrays, "original_data") if "original_data" in state["matrices"] else self.data
+            self.clustering_data = self.__import_matrix__(state, arrays, "clustering_data") if "clustering_data" in state["matrices"] else self.data
+            if isinstance(self.clustering_data, list):
+                self.clustering_data = numpy.array(self.clustering_data, dtype=float)
+            self.clustering = arrays["clustering"]
+            self.column_clustering = arrays["column_clustering"]
+            self.data_order = arrays["data_order"]
+
+        self.rdmols = False
+        self.fpobjs = False
+
+    def __export_matrix__(self, state, arrays, name, matrix):
+        if sparse.issparse(matrix):
+            matrix = matrix.tocsr()
+            state["matrices"][name] = "sparse"
+            arrays[name + "_data"], arrays[name + "_indices"], arrays[name + "_indptr"] = matrix.data, matrix.indices, matrix.indptr
+            arrays[name + "_shape"] = numpy.array(matrix.shape)
+        elif isinstance(matrix, numpy.ndarray):
+            state["matrices"][name] = "array"
+            arrays[name] = matrix
+        else:
+            state["matrices"][name] = "list"
+            arrays[name] = numpy.array([[numpy.nan if v is None else v for v in row] for row in matrix], dtype=float)
+
+    def __import_matrix__(self, state, arrays, name):
+        if state["matrices"][name] == "sparse":
+            return sparse.csr_matrix((arrays[name + "_data"], arrays[name + "_indices"], arrays[name + "_indptr"]), shape=tuple(arrays[name + "_shape"]))
+        elif state["matrices"][name] == "array":
+            return arrays[name]
+        return [[None if numpy.isnan(v) else v for v in row] for row in arrays[name].tolist()]
+
+    def insert_rows(self, rows, header=False, max_drift=0.1, max_inserted=0.5):
+        """Inserts new rows into already clustered data without clustering all the rows again.
+        The rows are expected in the same layout as in read_data. Only the distances between the new rows
+        and the clustered rows are calculated. Each new row climbs from its nearest row up the dendrogram while its
+        linkage distance to the cluster (Lance-Williams update of the row_linkage) exceeds the height of the next merge
+        and is attached there. The merges above keep their heights, but the height the parent merge would get with
+        the new row is compared with its current height. These changes relative to the dendrogram height sum up to the drift
+        and when it exceeds max_drift, all the rows are clustered again (the column order is kept).
+        The rows are also clustered again when the count of rows inserted since the last clustering exceeds
+        the max_inserted fraction of the clustered rows. Create a new Dendrogram afterwards."""
+        if self.clustering_data is False:
+            raise Exception("Rows can't be inserted into the data clustered in the lean mode.")
+
+        rows = [list(row) for row in rows]
+        smiles = False
+        labels = False
+        data_start = 0
+
+        if header and self.compound_structure_field and self.compound_structure_field in rows[0]:
+            csf_index = rows[0].index(self.compound_structure_field)
+            smiles = [row[csf_index] for row in rows[1:]]
+
+            for row in rows:
+                row.pop(csf_index)
+
+        if header and self.label_field:
+            label_index = rows[0].index(self.label_field)
+            labels = [row[label_index] for row in rows[1:]]
+
+            for row in rows:
+                row.pop(label_index)
+
+        if header:
+            data_start = 1
+
+        rows = rows[data_start:]
+        if not rows:
+            return
+
+        if (self.smiles and not smiles) or (self.labels and not labels):
+            raise Exception("New rows must contain the same compound structure and label fields as the clustered data.")
+
+        values = [[None if not self.missing_values is False and v in self.missing_values else float(v) for v in row[1:]] for row in rows]
+
+        if self.clustered_by_structures:
+            if not RDKIT:
+                raise Exception("RDKit is needed to insert rows into data clustered by compound structures.")
+            vectors = numpy.array([FP2FNC["ecfp4"](Chem.MolFromSmiles(s)).ToList() for s in smiles], dtype=float)
+        else:
+            vectors = self.__transform_new_rows__(values)
+
+        print("Inserting rows:", len(rows))
+        self.data_names.extend([str(row[0]) for row in rows])
+        if self.smiles:
+            self.smiles.extend(smiles)
+        if self.labels:
+            self.labels.extend(labels)
+
+        clustered_rows = self.clustering_data.shape[0]
+        shared_data = self.clustering_data is self.data
+
+        if sparse.issparse(self.data):
+            features = (sparse.csr_matrix(numpy.array(values, dtype=float)) != 0).astype(float)
+            if self.clustering_axis == "both" and len(self.column_clustering):
+                features = features[:, self.data_order[::-1]]
+
+            self.data = sparse.vstack([self.data, features], format="csr")
+            self.original_data = self.data
+
+        else:
+            if self.write_original or self.datatype == "nominal" or self.clustered_by_structures:
+                features = [list(row) for row in values]
+            else:
+                # vectors of the normalized data are already rounded like in normalize_data
+                features = [[float(v) if not values[i][j] is None else None for j, v in enumerate(row)] for i, row in enumerate(vectors)]
+            originals = [list(row) for row in values]
+
+            if self.clustering_axis == "both" and len(self.column_clustering):
+                features = self.__reorder_data__(features, self.data_order)
+                originals = self.__reorder_data__(originals, self.data_order)
+
+            shared_original = self.original_data is self.data
+            self.data = self.__append_rows__("data", features)
+            self.original_data = self.data if shared_original else self.__append_rows__("original_data", originals)
+
+        if shared_data:
+            self.clustering_data = self.data
+        elif sparse.issparse(self.clustering_data):
+            self.clustering_data = sparse.vstack([self.clustering_data, (sparse.csr_matrix(vectors) != 0).astype(float)], format="csr")
+        else:
+            self.clustering_data = self.__append_rows__("clustering_data", vectors)
+        self.inserted_count += len(rows)
+
+        if self.inserted_count > max_inserted*self.clustered_count:
+            print("Inserted rows exceed {} of the clustered rows, clustering all rows again...".format(max_inserted))
+            self.__cluster_rows__()
+            return
+
+        if sparse.issparse(self.clustering_data):
+            distances = self.__sparse_distances__(vectors, self.clustering_data, self.row_distance)
+        else:
+            distances = spatial.distance.cdist(vectors, self.clustering_data, self.row_distance)
+        self.clustering, drift = self.__insert_leaves__(self.clustering, distances, clustered_rows)
+        self.drift += drift
+
+        if self.drift > max_drift:
+            print("Dendrogram drift {:.3f} exceeds {}, clustering all rows again...".format(self.drift, max_drift))
+            self.__cluster_rows__()
+        elif not hcluster.is_valid_linkage(self.clustering) or (not self.row_linkage in ["centroid", "median"] and not hcluster.is_monotonic(self.clustering)):
+            print("Rows were inserted into an invalid dendrogram, clustering all rows again...")
+            self.__cluster_rows__()
+
+    def __append_rows__(self, name, rows):
+        # matrix rows are appended to a buffer with spare rows, so the repeated insertions don't copy the whole matrix
+        data = getattr(self, name)
+        if not isinstance(data, numpy.ndarray):
+            data.extend(rows)
+            return data
+
+        row_count = data.shape[0] + len(rows)
+        buffer = self.row_buffers.get(name)
+        if buffer is None or not data.base is buffer or buffer.shape[0] < row_count:
+            buffer = numpy.empty((row_count + row_count//4, data.shape[1]), dtype=data.dtype if data.dtype.kind == "f" else float)
+            buffer[:data.shape[0]] = data
+            self.row_buffers[name] = buffer
+
+        buffer[data.shape[0]:row_count] = numpy.array(rows, dtype=float)
+        return buffer[:row_count]
+
+    def __transform_new_rows__(self, values):
+        vectors = numpy.array([[numpy.nan if v is None else v for v in row] for row in values], dtype=float)
+
+        if self.normalization:
+            vectors = numpy.round(vectors*numpy.array(self.normalization["scale"]) + numpy.array(self.normalization["min"]), 3)
+
+        if numpy.isnan(vectors).any():
+            if self.datatype == "binary":
+                fill = (self.clustering_data.mean(axis=0) > 0.5).astype(float)
+            else:
+                fill = numpy.round(self.clustering_data.mean(axis=0), 3)
+            vectors = numpy.where(numpy.isnan(vectors), fill, vectors)
+
+        return vectors
+
+    def __insert_leaves__(self, clustering, distances, leaf_count):
+        # leaves keep their non-negative ids, merged nodes get negative ids until the linkage matrix is rebuilt
+        nodes = {}
+        parents = {}
+        for i, (left, right, distance, count) in enumerate(clustering):
+            node_id = -(i+1)
+            nodes[node_id] = [self.__to_node_id__(left, leaf_count), self.__to_node_id__(right, leaf_count), distance, int(count)]
+            parents[nodes[node_id][0]] = node_id
+            parents[nodes[node_id][1]] = node_id
+
+        linkage_distance = LANCE_WILLIAMS[self.row_linkage]
+        scale = float(numpy.max(clustering[:, 2])) if len(clustering) else 0.0
+        scale = scale if scale > 0 else 1.0
+        drift = 0.0
+
+        for i, row_distances in enumerate(distances):
+            leaf = leaf_count + i
+            child = int(numpy.argmin(row_distances[:leaf]))
+            distance = float(row_distances[child])
+            parent = parents.get(child)
+
+            while not parent is None:
+                sibling = nodes[parent][1] if nodes[parent][0] == child else nodes[parent][0]
+                sibling_distance = self.__node_distance__(nodes, sibling, row_distances)
+                if distance <= nodes[parent][2]:
+                    break
+
+                distance = linkage_distance(distance, sibling_distance, nodes[parent][2], self.__node_count__(nodes, child), self.__node_count__(nodes, sibling), 1)
+                child = parent
+                parent = parents.get(child)
+
+            if parent is None:
+                drift += max(0.0, distance - (nodes[child][2] if child < 0 else 0.0))/scale
+            else:
+                parent_distance = linkage_distance(nodes[parent][2], sibling_distance, distance, self.__node_count__(nodes, child), 1, self.__node_count__(nodes, sibling))
+                drift += abs(parent_distance - nodes[parent][2])/scale
+
+            node_id = -(len(nodes)+1)
+            nodes[node_id] = [child, leaf, max(distance, nodes[child][2] if child < 0 else 0.0), self.__node_count__(nodes, child) + 1]
+            parents[child] = node_id
+            parents[leaf] = node_id
+
+            if not parent is None:
+                nodes[parent][nodes[parent].index(child)] = node_id
+                parents[node_id] = parent
+
+                while not parent is None:
+                    nodes[parent][3] += 1
+                    parent = parents.get(parent)
+
+        return self.__nodes_to_linkage__(nodes, leaf_count + len(distances)), drift
+
+    def __node_count__(self, nodes, node_id):
+        return nodes[node_id][3] if node_id < 0 else 1
+
+    def __node_distance__(self, nodes, node_id, row_distances):
+        # linkage distance of the new row to the node, calculated bottom-up by the Lance-Williams updates of its subtree
+        if node_id >= 0:
+            return float(row_distances[node_id])
+
+        linkage_distance = LANCE_WILLIAMS[self.row_linkage]
+        node_distances = {}
+        stack = [node_id]
+        while stack:
+            children = nodes[stack[-1]][:2]
+            pending = [c for c in children if c < 0 and not c in node_distances]
+            if pending:
+                stack.extend(pending)
+                continue
+
+            current = stack.pop()
+            a, b = [node_distances[c] if c < 0 else float(row_distances[c]) for c in children]
+            node_distances[current] = linkage_distance(a, b, nodes[current][2], self.__node_count__(nodes, children[0]), self.__node_count__(nodes, children[1]), 1)
+
+        return node_distances[node_id]
+
+    def __to_node_id__(self, cluster_id, leaf_count):
+        cluster_id = int(cluster_id)
+        return cluster_id if cluster_id < leaf_count else -(cluster_id - leaf_count + 1)
+
+    def __nodes_to_linkage__(self, nodes, leaf_count):
+        # merged nodes are ordered by distance, each one only after both of its children
+        waiting = {node_id: len([c for c in node[:2] if c < 0]) for node_id, node in nodes.items()}
+        parents = {c: node_id for node_id, node in nodes.items() for c in node[:2] if c < 0}
+        ready = [(node[2], node[3], node_id) for node_id, node in nodes.items() if waiting[node_id] == 0]
+        heapq.heapify(ready)
+        node_id2cluster_id = {}
+        clustering = []
+
+        while ready:
+            distance, count, node_id = heapq.heappop(ready)
+            node_id2cluster_id[node_id] = leaf_count + len(clustering)
+            left, right = [c if c >= 0 else node_id2cluster_id[c] for c in nodes[node_id][:2]]
+            clustering.append([left, right, distance, count])
+
+            parent = parents.get(node_id)
+            if not parent is None:
+                waiting[parent] -= 1
+                if waiting[parent] == 0:
+                    heapq.heappush(ready, (nodes[parent][2], nodes[parent][3], parent))
+
+        return numpy.array(clustering, dtype=float)
+
 def _process_(arguments):
-    c = Cluster()
-    c.read_csv(
-        filename=arguments.data_file, 
-        delimiter=arguments.data_delimiter, 
-        header=arguments.data_header, 
-        missing_values=arguments.missing_values, 
-        datatype=arguments.datatype,
-        compound_structure_field=arguments.compound_structure_field,
-        add_structures=arguments.add_structures,
-        label_field=arguments.label_field
-    )
+    c = Cluster(lean=arguments.lean)
+    if arguments.sparse:
+        c.read_sparse_csv(filename=arguments.data_file, delimiter=arguments.data_delimiter, header=arguments.data_header)
+    elif os.path.splitext(arguments.data_file)[1] in [".npy", ".npz"]:
+        c.read_npy(filename=arguments.data_file, datatype=arguments.datatype, add_structures=arguments.add_structures)
+    elif os.path.splitext(arguments.data_file)[1] in [".parquet", ".feather", ".arrow"]:
+        c.read_columnar(
+            filename=arguments.data_file,
+            label_field=arguments.label_field,
+            compound_structure_field=arguments.compound_structure_field,
+            add_structures=arguments.add_structures,
+            datatype=arguments.datatype
+        )
+    else:
+        c.read_csv(
+            filename=arguments.data_file, 
+            delimiter=arguments.data_delimiter, 
+            header=arguments.data_header, 
+            missing_values=arguments.missing_values, 
+            datatype=arguments.datatype,
+            compound_structure_field=arguments.compound_structure_field,
+            add_structures=arguments.add_structures,
+            label_field=arguments.label_field
+        )
     
     if arguments.normalize:
         c.normalize_data(feature_range=(0,1), write_original=arguments.write_original)
@@ -746,7 +1710,8 @@ def _process_(arguments):
         axis=arguments.axis,
         column_distance=arguments.column_distance,
         column_linkage=arguments.column_linkage,
-        cluster_by_structures=arguments.cluster_by_structures
+        cluster_by_structures=arguments.cluster_by_structures,
+        collapse_duplicates=arguments.collapse_duplicates
     )
 
     d = Dendrogram(c)
@@ -764,26 +1729,35 @@ def _process_(arguments):
     if arguments.alternative_data:
         d.add_alternative_data_from_file(alternative_data_file=arguments.alternative_data, delimiter=arguments.alternative_data_delimiter, header=arguments.alternative_data_header, alternative_data_compressed_value=arguments.alternative_data_compressed_value)
     
+    if arguments.tile_dir:
+        d.export_heatmap_tiles(arguments.tile_dir, tile_size=arguments.tile_size)
+
     if arguments.output_file or arguments.html_dir:
         if arguments.output_file:
             d.export_cluster_heatmap_as_json(arguments.output_file, minify=arguments.minify, dump=arguments.json_dump)
         else:
-            d.export_cluster_heatmap_as_html(arguments.html_dir)
+            d.export_cluster_heatmap_as_html(arguments.html_dir, libdir=arguments.html_libdir, compress_data=arguments.html_compress_data, download_libs=not arguments.html_offline)
     else:
         print(d.export_cluster_heatmap_as_json(filename=None, minify=arguments.minify, dump=arguments.json_dump))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument("data_file", type=str, help="csv(text) data file with delimited values")
+    parser.add_argument("data_file", type=str, help="csv(text) data file with delimited values, .npy/.npz matrix or .parquet/.feather/.arrow columnar file")
     parser.add_argument("-o", "--output_file", type=str, help="the name of output file")
     parser.add_argument("-html", "--html_dir", type=str, help="the directory to store HTML page with dependencies")
+    parser.add_argument("-tiles", "--tile_dir", type=str, default=None, help="the directory to store PNG tiles of the heatmap")
+    parser.add_argument("-ts", "--tile_size", type=int, default=256, help="the size of the heatmap tiles in pixels (even)")
+    parser.add_argument("-hl", "--html_libdir", type=str, default=LIBDIR, help="the directory with local InCHlib, jQuery and KineticJS sources for the HTML page")
+    parser.add_argument("-hcd", "--html_compress_data", default=False, help="gzip the data file fetched by the HTML page (the page must be served over HTTP then)", action="store_true")
+    parser.add_argument("-hoff", "--html_offline", default=False, help="don't download the InCHlib, jQuery and KineticJS sources missing in the html_libdir from the InCHlib server", action="store_true")
     parser.add_argument("-rd", "--row_distance", type=str, default="euclidean", help="set the distance to use for clustering rows")
     parser.add_argument("-rl", "--row_linkage", type=str, default="ward", help="set the linkage to use for clustering rows")
     parser.add_argument("-cd", "--column_distance", type=str, default="euclidean", help="set the distance to use for clustering columns (only when clustering by both axis -a parameter)")
     parser.add_argument("-cl", "--column_linkage", type=str, default="ward", help="set the linkage to use for clustering columns (only when clustering by both axis -a parameter)")
     parser.add_argument("-a", "--axis", type=str, default="row", help="define clustering axis (row/both)")
     parser.add_argument("-dt", "--datatype", type=str, default="numeric", help="specify the type of the data (numeric/binary)")
+    parser.add_argument("-sp", "--sparse", default=False, help="read binary data file in a sparse triplet format (row id, column name[, value])", action="store_true")
     parser.add_argument("-dd", "--data_delimiter", type=str, default=",", help="delimiter of values in data file")
     parser.add_argument("-m", "--metadata", type=str, default=None, help="csv(text) metadata file with delimited values")
     parser.add_argument("-md", "--metadata_delimiter", type=str, default=",", help="delimiter of values in metadata file")
@@ -809,6 +1783,8 @@ if __name__ == '__main__':
     parser.add_argument("-csf", "--compound_structure_field", type=str, default=False, help="the name of a column with a compound structure")
     parser.add_argument("-as", "--add_structures", default=False, help="add structure smiles to the output json format", action="store_true")
     parser.add_argument("-cbs", "--cluster_by_structures", default=False, help="cluster by compound structures (fingerprints)", action="store_true")
+    parser.add_argument("-cdup", "--collapse_duplicates", default=False, help="cluster only unique rows and join duplicates to them in zero distance (single and complete linkage only)", action="store_true")
+    parser.add_argument("-lean", "--lean", default=False, help="release intermediate data between the clustering stages to decrease memory usage", action="store_true")
     parser.add_argument("-lf", "--label_field", type=str, default=False, help="set a label field name in case it is in the data file")
     
     args = parser.parse_args()